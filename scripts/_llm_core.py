@@ -0,0 +1,870 @@
+"""
+Shared model loading + JSON generation for the GLB LLM scripts.
+Prompt content lives with the callers; they register it via configure().
+"""
+
+import contextlib
+import copy
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import transformers
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+import torch
+
+from _llm_settings import MAX_BATCH, MAX_NEW_TOKENS, cache_dir, gguf_path, model_name
+
+try:
+  from outlines.models.transformers import TransformerTokenizer
+  from outlines.processors import JSONLogitsProcessor
+except ImportError:  # optional: constrained decoding is skipped without it
+  JSONLogitsProcessor = None
+
+try:
+  from llama_cpp import Llama, LlamaGrammar
+except ImportError:  # optional: only needed for GLB_LLM_GGUF
+  Llama = None
+
+MODEL_CACHE: Dict[str, Any] = {}
+
+# Set by configure(): the prompt prefix shared by every request and the JSON
+# schema answers must follow.
+_CONFIG: Dict[str, Any] = {"prompt_prefix": "", "response_schema": None}
+
+RETRY_INSTRUCTIONS = "\n\nIMPORTANT: Your previous response could not be parsed as JSON. " \
+                     "Now respond with ONLY a single valid JSON object, no explanation."
+
+
+def configure(prompt_prefix: str = "", response_schema: Optional[Dict[str, Any]] = None):
+  """
+  Register the text every prompt starts with (tokenized and prefilled once)
+  and the schema used to constrain decoding. Call before get_model().
+  """
+  _CONFIG["prompt_prefix"] = prompt_prefix
+  _CONFIG["response_schema"] = response_schema
+
+
+def _snapshot_path(name: str, dtype, attn: str) -> str:
+  """
+  Location of the torch-serialized snapshot for a given model name, dtype
+  and attention kernel. The pickled model keeps the kernel it was built
+  with, so installing flash_attn (or losing it) must not reuse a snapshot.
+  Unpickling skips __init__, so a snapshot from another torch/transformers
+  release may load fine and only break inside generate(): the versions are
+  part of the key too.
+  """
+  key = f"{name}\0{dtype}\0{attn}\0{torch.__version__}\0{transformers.__version__}"
+  digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+  return os.path.join(cache_dir(), f"{digest}.pt")
+
+
+def _cuda_dtype():
+  """
+  bf16 has fp32's exponent range, so generate() is less prone to overflow
+  than with fp16 while still halving weight bandwidth. GPUs before Ampere
+  only emulate it, so they get fp16.
+  """
+  return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+def _cpu_bf16_supported() -> bool:
+  """
+  Whether this CPU has native bf16 matmuls (AVX512-BF16 or AMX). Without
+  them bf16 is emulated and slower than fp32, so fp32 stays the default.
+  """
+  for probe in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+    check = getattr(torch.cpu, probe, None)
+    try:
+      if check is not None and check():
+        return True
+    except Exception:
+      pass
+  return False
+
+
+def _model_dtype():
+  if torch.cuda.is_available():
+    return _cuda_dtype()
+  return torch.bfloat16 if _cpu_bf16_supported() else torch.float32
+
+
+def _attn_implementations(dtype) -> List[str]:
+  """
+  Attention kernels to try, best first. FlashAttention-2 needs the flash_attn
+  package, a GPU and half precision; SDPA is fused scaled-dot-product
+  attention, where PyTorch picks a flash/mem-efficient/math kernel per
+  device instead of materialising the full score matrix.
+  """
+  candidates = ["sdpa"]
+  if (
+      torch.cuda.is_available()
+      and dtype in (torch.float16, torch.bfloat16)
+      and importlib.util.find_spec("flash_attn") is not None
+  ):
+    candidates.insert(0, "flash_attention_2")
+  return candidates
+
+
+def _load_weights(name: str):
+  """Build tokenizer + model from the local snapshot, or from HF on a miss."""
+  device = "cuda" if torch.cuda.is_available() else "cpu"
+  dtype = _model_dtype()
+  attn_candidates = _attn_implementations(dtype)
+  cache_path = _snapshot_path(name, dtype, attn_candidates[0])
+  quant = os.getenv("GLB_LLM_QUANT", "").lower()
+  if quant and quant != "nf4":
+    print(f"[llm_core] Unknown GLB_LLM_QUANT={quant!r}, loading unquantized", file=sys.stderr)
+    quant = ""
+  if quant and device != "cuda":
+    # bitsandbytes 4-bit kernels are CUDA-only.
+    print("[llm_core] GLB_LLM_QUANT needs CUDA, loading unquantized", file=sys.stderr)
+    quant = ""
+
+  # A previous run already paid the from_pretrained cost; a single
+  # torch.load is much cheaper than re-parsing configs + safetensors shards.
+  # bitsandbytes weights do not round-trip through torch.save, so quantized
+  # loads always go through from_pretrained.
+  if not quant and os.path.exists(cache_path):
+    try:
+      blob = torch.load(cache_path, map_location=device, weights_only=False)
+      print(f'[llm_core] Using model snapshot: {cache_path}', file=sys.stderr)
+      return blob["tok"], blob["model"]
+    except Exception as e:
+      print(f"[llm_core] Ignoring unreadable snapshot {cache_path}: {e}", file=sys.stderr)
+
+  print(f'[llm_core] Using model: {name}', file=sys.stderr)
+
+  tok = AutoTokenizer.from_pretrained(name, use_fast=True)
+  model_kwargs: Dict[str, Any] = {
+      "torch_dtype": dtype,
+      "device_map": "auto",
+      "low_cpu_mem_usage": True,
+  }
+  if quant == "nf4":
+    # Weight-only NF4: the weights are dequantized into the compute dtype per
+    # matmul, which saves bandwidth even at batch size 1 (unlike int8
+    # activations, which need large batches to pay off).
+    model_kwargs["quantization_config"] = BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=_cuda_dtype(),
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+    )
+  model = None
+  for attn in attn_candidates:
+    try:
+      model = AutoModelForCausalLM.from_pretrained(name, attn_implementation=attn, **model_kwargs)
+      break
+    except (TypeError, ValueError, ImportError) as e:
+      # Older transformers releases (or models without support for this
+      # kernel) reject it; try the next one.
+      print(f"[llm_core] {attn} attention unavailable: {e}", file=sys.stderr)
+  if model is None:
+    model = AutoModelForCausalLM.from_pretrained(name, **model_kwargs)
+
+  if quant:
+    return tok, model
+
+  # Write to a private temp file and rename it into place, so a concurrent
+  # worker (or a crash mid-write) never leaves a truncated snapshot behind.
+  tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    torch.save({"tok": tok, "model": model}, tmp_path)
+    os.replace(tmp_path, cache_path)
+  except Exception as e:
+    # The snapshot is only an optimisation; never fail a classification over it.
+    print(f"[llm_core] Could not write snapshot {cache_path}: {e}", file=sys.stderr)
+    try:
+      os.remove(tmp_path)
+    except OSError:
+      pass
+
+  return tok, model
+
+
+def _compile_model(tok, model) -> bool:
+  """
+  Compile the decode step with a static KV cache (GLB_LLM_COMPILE=1).
+  A one-token warmup triggers compilation up front; if Inductor fails for
+  any reason the model is put back into eager mode.
+  """
+  eager_forward = model.forward
+  try:
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True)
+    warmup = tok("{", return_tensors="pt").to(model.device)
+    with torch.inference_mode():
+      model.generate(**warmup, max_new_tokens=1, do_sample=False)
+    return True
+  except Exception as e:
+    print(f"[llm_core] torch.compile failed, using eager mode: {e}", file=sys.stderr)
+    model.forward = eager_forward
+    model.generation_config.cache_implementation = None
+    return False
+
+
+def _build_json_processor(tok):
+  """
+  Logits processor that only allows tokens forming the configured schema, or
+  None when there is no schema, outlines is missing, or it cannot handle
+  this tokenizer. The schema is compiled once here; each generate call works
+  on a fresh copy.
+  """
+  schema = _CONFIG["response_schema"]
+  if JSONLogitsProcessor is None or schema is None:
+    return None
+  try:
+    return JSONLogitsProcessor(json.dumps(schema), TransformerTokenizer(tok))
+  except Exception as e:
+    print(f"[llm_core] JSON-constrained decoding disabled: {e}", file=sys.stderr)
+    return None
+
+
+def _logits_processor() -> Optional[LogitsProcessorList]:
+  processor = MODEL_CACHE.get("json_processor")
+  if processor is None:
+    return None
+  return LogitsProcessorList([processor.copy()])
+
+
+def _import_ipex():
+  """
+  intel_extension_for_pytorch, or None (optional: fused CPU kernels for the
+  bf16 path). Imported only where it is used: on a torch version mismatch
+  its __init__ prints to stdout and calls exit(), which would kill a
+  --serve worker and garble its JSON-lines stdout.
+  """
+  try:
+    with contextlib.redirect_stdout(sys.stderr):
+      import intel_extension_for_pytorch as ipex
+  except ImportError:
+    return None
+  except SystemExit as e:
+    print(f"[llm_core] intel_extension_for_pytorch unusable (exit {e.code})", file=sys.stderr)
+    return None
+  return ipex
+
+
+def get_model():
+  """Load (or reuse) the HF model + tokenizer."""
+  if MODEL_CACHE:
+    return MODEL_CACHE["tok"], MODEL_CACHE["model"]
+
+  # The first call usually comes from inside an inference_mode generate
+  # helper. Tensors created there are inference tensors, which cannot be
+  # written to outside inference mode, and the prefetch thread (which does
+  # not inherit the mode) copies prompt ids into input_buf in place.
+  with torch.inference_mode(False):
+    return _init_model()
+
+
+def _init_model():
+  tok, model = _load_weights(model_name())
+  # Inference only: no dropout, and no autograd bookkeeping (see the
+  # inference_mode blocks around every model call).
+  model.eval()
+
+  if model.device.type == "cpu" and model.dtype == torch.bfloat16:
+    # Fused attention/MLP kernels for bf16 on Intel CPUs.
+    ipex = _import_ipex()
+    if ipex is not None:
+      try:
+        model = ipex.llm.optimize(model, dtype=torch.bfloat16, inplace=True)
+      except Exception as e:
+        print(f"[llm_core] ipex optimization skipped: {e}", file=sys.stderr)
+
+  # Opt-in: compilation takes a while up front, and the static cache it needs
+  # turns off prefix KV reuse (see use_prefix_cache), so every prompt is
+  # prefilled in full. Only a worker that lives for many sections gains.
+  compiled = False
+  if os.getenv("GLB_LLM_COMPILE") == "1":
+    compiled = _compile_model(tok, model)
+
+  MODEL_CACHE["tok"] = tok
+  MODEL_CACHE["model"] = model
+  MODEL_CACHE["compiled"] = compiled
+  # GLB_LLM_KV_OFFLOAD=1 keeps the KV cache in host memory and streams it to
+  # the GPU layer by layer, for long prompts on small cards. It relies on CUDA
+  # streams and cannot be combined with the compiled static cache.
+  MODEL_CACHE["offload"] = (
+      os.getenv("GLB_LLM_KV_OFFLOAD") == "1"
+      and torch.cuda.is_available()
+      and not compiled
+  )
+  MODEL_CACHE["json_processor"] = _build_json_processor(tok)
+  # Page-locked staging buffer for prompt ids so host->device copies can run
+  # asynchronously without allocating a fresh pinned tensor per request.
+  MODEL_CACHE["input_buf"] = None
+  MODEL_CACHE["input_event"] = None
+  # Side stream for copying the next batch's prompts while generate runs.
+  MODEL_CACHE["copy_stream"] = None
+  if torch.cuda.is_available():
+    MODEL_CACHE["input_buf"] = torch.empty((1, 4096), dtype=torch.long, pin_memory=True)
+    MODEL_CACHE["copy_stream"] = torch.cuda.Stream()
+  # The shared prefix never changes, so it is tokenized exactly once.
+  MODEL_CACHE["prefix_ids"] = None
+  if _CONFIG["prompt_prefix"]:
+    MODEL_CACHE["prefix_ids"] = tok(
+        _CONFIG["prompt_prefix"], return_tensors="pt"
+    ).input_ids.to(model.device)
+  return tok, model
+
+
+def get_llama():
+  """
+  Load (or reuse) the llama.cpp model named by GLB_LLM_GGUF. A Q4_K_M/Q5_K_M
+  GGUF runs fused quantized kernels on CPU without PyTorch op dispatch.
+  """
+  if "llama" in MODEL_CACHE:
+    return MODEL_CACHE["llama"]
+  if Llama is None:
+    raise RuntimeError("GLB_LLM_GGUF is set but llama-cpp-python is not installed")
+
+  path = gguf_path()
+  print(f'[llm_core] Using GGUF model: {path}', file=sys.stderr)
+  MODEL_CACHE["llama"] = Llama(
+      model_path=path,
+      n_ctx=4096,
+      n_threads=os.cpu_count(),
+      n_batch=512,
+      # Offload every layer when llama.cpp was built with GPU support; a CPU
+      # build ignores this.
+      n_gpu_layers=-1 if torch.cuda.is_available() else 0,
+      verbose=False,
+  )
+  MODEL_CACHE["llama_grammar"] = _build_llama_grammar()
+  return MODEL_CACHE["llama"]
+
+
+def _build_llama_grammar():
+  """
+  GBNF grammar for the configured schema, so llama.cpp can only sample
+  schema-valid JSON. None without a schema or if the conversion fails.
+  """
+  schema = _CONFIG["response_schema"]
+  if schema is None:
+    return None
+  try:
+    return LlamaGrammar.from_json_schema(json.dumps(schema), verbose=False)
+  except Exception as e:
+    print(f"[llm_core] Grammar-constrained decoding disabled: {e}", file=sys.stderr)
+    return None
+
+
+def _llama_generate(prompt: str) -> Dict[str, Any]:
+  """
+  Greedy-generate one prompt with llama.cpp and parse the JSON. The output is
+  streamed so decoding stops as soon as a parseable object has been emitted.
+  llama.cpp keeps the KV state of the previous prompt and only evaluates the
+  tokens past the common prefix, so the shared instructions are prefilled
+  once per process here too.
+  """
+  llm = get_llama()
+  buf = io.StringIO()
+  for chunk in llm(
+      prompt,
+      max_tokens=MAX_NEW_TOKENS,
+      # Pure argmax like the transformers path: deterministic, so answers
+      # can be cached, and no penalty pass over the logits per token.
+      temperature=0.0,
+      repeat_penalty=1.0,
+      grammar=MODEL_CACHE["llama_grammar"],
+      stream=True,
+  ):
+    piece = chunk["choices"][0]["text"]
+    buf.write(piece)
+    # Only a closing brace can complete an object.
+    if "}" in piece and has_json_answer(buf.getvalue()):
+      break
+  try:
+    return extract_json(buf.getvalue())
+  except ValueError as e:
+    raise UnparsableOutput(str(e))
+
+
+def _llama_generate_text(prompt: str, max_new_tokens: int) -> Tuple[str, bool]:
+  """Unconstrained greedy llama.cpp completion; see run_generate_text."""
+  llm = get_llama()
+  out = llm(prompt, max_tokens=max_new_tokens, temperature=0.0, repeat_penalty=1.0)
+  choice = out["choices"][0]
+  return choice["text"], choice.get("finish_reason") != "length"
+
+
+def iter_json_objects(text: str) -> Iterator[str]:
+  """
+  Each closed top-level {...} in text, in order. One pass tracking depth,
+  string state and backslash escapes, so braces inside strings (e.g. an
+  echoed schema or "{ }" in HTML) do not count and trailing prose or a
+  second object is never swept into the first.
+  """
+  depth = 0
+  start = -1
+  in_string = False
+  escape = False
+  for i, ch in enumerate(text):
+    if in_string:
+      if escape:
+        escape = False
+      elif ch == "\\":
+        escape = True
+      elif ch == '"':
+        in_string = False
+    elif ch == '"' and depth > 0:
+      in_string = True
+    elif ch == "{":
+      if depth == 0:
+        start = i
+      depth += 1
+    elif ch == "}" and depth > 0:
+      depth -= 1
+      if depth == 0:
+        yield text[start:i + 1]
+
+
+def has_json_answer(text: str) -> bool:
+  """Whether text already holds an object extract_json would accept."""
+  try:
+    extract_json(text)
+    return True
+  except ValueError:
+    return False
+
+
+class JSONBalancedStop(StoppingCriteria):
+  """Stop each row as soon as its generated tail holds a parseable JSON object."""
+
+  def __init__(self, tok, start_len: int):
+    self.tok = tok
+    self.start_len = start_len
+
+  def __call__(self, input_ids, scores, **kwargs):
+    # An object can only become complete on a token containing "}", so the
+    # full tail is decoded and scanned only for rows that just produced one.
+    done = [False] * input_ids.shape[0]
+    if input_ids.shape[1] > self.start_len:
+      last = self.tok.batch_decode(input_ids[:, -1:], skip_special_tokens=True)
+      for i, piece in enumerate(last):
+        if "}" in piece:
+          tail = self.tok.decode(input_ids[i, self.start_len:], skip_special_tokens=True)
+          done[i] = has_json_answer(tail)
+    return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def prefix_cache():
+  """
+  Prefill the configured prompt prefix once and return its past_key_values.
+  Every prompt starts with the same instructions, so their attention
+  keys/values only need to be computed a single time per process.
+  """
+  _, model = get_model()
+  if "prefix_past" not in MODEL_CACHE:
+    with torch.inference_mode():
+      prefix_out = model(MODEL_CACHE["prefix_ids"], use_cache=True)
+    MODEL_CACHE["prefix_past"] = prefix_out.past_key_values
+  return MODEL_CACHE["prefix_past"]
+
+
+def use_prefix_cache() -> bool:
+  """
+  The shared prefix cache is a DynamicCache that gets deep-copied per call.
+  A compiled model owns a static cache that cannot be seeded from it, and an
+  offloaded cache holds CUDA streams that cannot be copied, so both of those
+  modes prefill the full prompt instead.
+  """
+  get_model()
+  return (
+      MODEL_CACHE["prefix_ids"] is not None
+      and not (MODEL_CACHE["compiled"] or MODEL_CACHE["offload"])
+  )
+
+
+def _has_prefix(prompt: str) -> bool:
+  return bool(_CONFIG["prompt_prefix"]) and prompt.startswith(_CONFIG["prompt_prefix"])
+
+
+def _cache_kwargs(inputs: Dict[str, Any]) -> Dict[str, Any]:
+  if MODEL_CACHE["offload"] and "past_key_values" not in inputs:
+    return {"cache_implementation": "offloaded"}
+  return {}
+
+
+def _to_device(ids):
+  """Move CPU token ids ([1, n]) to the model device via the pinned buffer."""
+  _, model = get_model()
+  buf = MODEL_CACHE["input_buf"]
+  if buf is None or ids.shape[1] > buf.shape[1]:
+    return ids.to(model.device)
+
+  # The previous non_blocking copy may still be reading the buffer.
+  if MODEL_CACHE["input_event"] is not None:
+    MODEL_CACHE["input_event"].synchronize()
+  staged = buf[:, :ids.shape[1]]
+  staged.copy_(ids)
+  on_device = staged.to(model.device, non_blocking=True)
+  event = torch.cuda.Event()
+  event.record()
+  MODEL_CACHE["input_event"] = event
+  return on_device
+
+
+def encode_prompt(prompt: str, tok=None):
+  """
+  Token ids (shape [1, n]) for a prompt. Prompts starting with the configured
+  prefix reuse its pre-tokenized ids and only tokenize their tail.
+  """
+  if tok is None:
+    tok, _ = get_model()
+
+  if not _has_prefix(prompt):
+    return _to_device(tok(
+        prompt,
+        return_tensors="pt",
+        truncation=True,
+        max_length=4096,
+    ).input_ids)
+
+  prefix_ids = MODEL_CACHE["prefix_ids"]
+  user_ids = _to_device(tok(
+      prompt[len(_CONFIG["prompt_prefix"]):],
+      return_tensors="pt",
+      add_special_tokens=False,
+      truncation=True,
+      max_length=4096 - prefix_ids.shape[1],
+  ).input_ids)
+  return torch.cat([prefix_ids, user_ids], dim=1)
+
+
+class UnparsableOutput(ValueError):
+  """
+  Model output without usable JSON. Carries the finished sequence and its KV
+  cache so a retry can keep decoding from it instead of prefilling again.
+  """
+
+  def __init__(self, message: str, sequences=None, past_key_values=None):
+    super().__init__(message)
+    self.sequences = sequences
+    self.past_key_values = past_key_values
+
+
+def _clean_json(text: str) -> str:
+  """
+  Strip // and /* */ comments and trailing commas from JSON-like text in one
+  left-to-right pass. String contents are copied untouched.
+  """
+  out: List[str] = []
+  i = 0
+  n = len(text)
+  while i < n:
+    ch = text[i]
+    if ch == '"':
+      # Copy the whole string literal, honouring backslash escapes.
+      j = i + 1
+      while j < n and text[j] != '"':
+        j += 2 if text[j] == "\\" else 1
+      out.append(text[i:j + 1])
+      i = j + 1
+      continue
+    if ch == "/" and text.startswith("//", i):
+      end = text.find("\n", i)
+      i = n if end < 0 else end
+      continue
+    if ch == "/" and text.startswith("/*", i):
+      end = text.find("*/", i + 2)
+      i = n if end < 0 else end + 2
+      continue
+    if ch in "]}":
+      # Drop a comma that only whitespace separates from the closer.
+      j = len(out) - 1
+      while j >= 0 and out[j].isspace():
+        j -= 1
+      if j >= 0 and out[j] == ",":
+        del out[j]
+    out.append(ch)
+    i += 1
+  return "".join(out)
+
+
+def extract_json(full_text: str) -> Dict[str, Any]:
+  """
+  Extract the first parseable JSON object from raw model output.
+  Unconstrained models sometimes add comments or trailing commas, so a
+  failed parse is retried once on the cleaned text; braces in leading prose
+  (e.g. "{placeholder}") are skipped in favour of the next object.
+  """
+  error: Optional[Exception] = None
+  for json_str in iter_json_objects(full_text):
+    try:
+      return json.loads(json_str)
+    except Exception as e:
+      error = error or e
+    try:
+      return json.loads(_clean_json(json_str))
+    except Exception:
+      pass
+
+  if error is None:
+    raise ValueError("No JSON object in model output")
+  raise ValueError(f"JSON parse failure: {error}")
+
+
+def _generate(inputs: Dict[str, Any], **generate_kwargs) -> Dict[str, Any]:
+  """Greedy-generate from prepared single-row inputs and parse the JSON."""
+  tok, model = get_model()
+
+  kwargs: Dict[str, Any] = {
+      "max_new_tokens": MAX_NEW_TOKENS,
+      "stopping_criteria": StoppingCriteriaList(
+          [JSONBalancedStop(tok, start_len=inputs["input_ids"].shape[1])]
+      ),
+      "logits_processor": _logits_processor(),
+      "do_sample": False,
+      "num_beams": 1,
+      "pad_token_id": tok.eos_token_id,
+      **_cache_kwargs(inputs),
+      **generate_kwargs,
+  }
+  with torch.inference_mode():
+    out = model.generate(**inputs, **kwargs, return_dict_in_generate=True)
+
+  # Only decode what the model produced: the prompt itself may contain a
+  # schema example, whose braces would otherwise be picked up as output.
+  full_text = tok.decode(out.sequences[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+  try:
+    return extract_json(full_text)
+  except ValueError as e:
+    raise UnparsableOutput(str(e), out.sequences, getattr(out, "past_key_values", None))
+
+
+@torch.inference_mode()
+def run_generate(prompt: str, **generate_kwargs) -> Dict[str, Any]:
+  """Generate a JSON answer for one prompt; extra kwargs go to model.generate."""
+  if gguf_path():
+    return _llama_generate(prompt)
+
+  input_ids = encode_prompt(prompt)
+  inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+  if _has_prefix(prompt) and use_prefix_cache():
+    # generate() only prefills the tokens past the cached prefix. The cache is
+    # copied because generation appends to it in place.
+    inputs["past_key_values"] = copy.deepcopy(prefix_cache())
+
+  return _generate(inputs, **generate_kwargs)
+
+
+@torch.inference_mode()
+def run_generate_text(prompt: str, max_new_tokens: int) -> Tuple[str, bool]:
+  """
+  Greedy free-text completion of one prompt, with no schema, JSON stop or
+  shared prefix. Returns the text and whether the model ended it itself
+  (False when max_new_tokens cut it off).
+  """
+  if gguf_path():
+    return _llama_generate_text(prompt, max_new_tokens)
+
+  tok, model = get_model()
+  input_ids = encode_prompt(prompt)
+  inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+  out = model.generate(
+      **inputs,
+      **_cache_kwargs(inputs),
+      max_new_tokens=max_new_tokens,
+      do_sample=False,
+      num_beams=1,
+      pad_token_id=tok.eos_token_id,
+  )
+  generated = out[0][input_ids.shape[1]:]
+  return tok.decode(generated, skip_special_tokens=True), generated.shape[0] < max_new_tokens
+
+
+def _encode_rows(prompts: List[str]) -> List[Any]:
+  """Token ids for each prompt, copied to the device on the side stream."""
+  tok = MODEL_CACHE["prefetch_tok"]
+  stream = MODEL_CACHE["copy_stream"]
+  if stream is None:
+    return [encode_prompt(p, tok)[0] for p in prompts]
+  with torch.cuda.stream(stream):
+    return [encode_prompt(p, tok)[0] for p in prompts]
+
+
+def _rows_ready(rows: List[Any]) -> List[Any]:
+  """Make the current stream wait for rows copied by _encode_rows."""
+  stream = MODEL_CACHE["copy_stream"]
+  if stream is not None:
+    current = torch.cuda.current_stream()
+    current.wait_stream(stream)
+    for row in rows:
+      # Keep the allocator from reusing the memory before generate is done.
+      row.record_stream(current)
+  return rows
+
+
+def run_generate_batch(prompts: List[str]) -> List[Any]:
+  """
+  Run several prompts through left-padded model.generate calls of up to
+  MAX_BATCH rows each. Returns one parsed dict per prompt, or the exception
+  that prompt raised.
+  """
+  if not prompts:
+    return []
+
+  if gguf_path():
+    # llama-cpp-python decodes one sequence at a time.
+    results: List[Any] = []
+    for prompt in prompts:
+      try:
+        results.append(_llama_generate(prompt))
+      except ValueError as e:
+        results.append(e)
+    return results
+
+  tok, _ = get_model()
+
+  pad_id = tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id
+
+  if use_prefix_cache():
+    prefix_cache()
+  # A fast tokenizer must not be used from two threads at once (the stopping
+  # criterion decodes on the main thread), so the prefetch thread gets a copy.
+  if "prefetch_tok" not in MODEL_CACHE:
+    MODEL_CACHE["prefetch_tok"] = copy.deepcopy(tok)
+
+  chunks = [prompts[start:start + MAX_BATCH] for start in range(0, len(prompts), MAX_BATCH)]
+  results = []
+  # Tokenizing and copying chunk k+1 runs on a helper thread (and, on CUDA,
+  # a side stream) while chunk k generates.
+  pool = ThreadPoolExecutor(max_workers=1)
+  try:
+    encoded = pool.submit(_encode_rows, chunks[0])
+    for k, chunk in enumerate(chunks):
+      rows = _rows_ready(encoded.result())
+      if k + 1 < len(chunks):
+        encoded = pool.submit(_encode_rows, chunks[k + 1])
+      results.extend(_generate_rows(chunk, rows, pad_id))
+  finally:
+    pool.shutdown(wait=True)
+
+  return results
+
+
+@torch.inference_mode()
+def _generate_rows(chunk: List[str], rows: List[Any], pad_id: int) -> List[Any]:
+  """One left-padded generate call over already-encoded prompt rows."""
+  tok, model = get_model()
+
+  # When every row starts with the configured prefix, its prefilled KV
+  # cache is shared by the whole batch and only the tails are prefilled.
+  past = None
+  shared = 0
+  if use_prefix_cache() and all(_has_prefix(p) for p in chunk):
+    past = copy.deepcopy(prefix_cache())
+    if hasattr(past, "batch_repeat_interleave"):
+      past.batch_repeat_interleave(len(rows))
+      shared = MODEL_CACHE["prefix_ids"].shape[1]
+    else:
+      past = None
+
+  # Causal LMs must be padded on the left so every row continues from its
+  # own last prompt token. With a shared prefix the padding goes between
+  # prefix and tail; it is masked out and position ids skip it.
+  width = max(r.shape[0] for r in rows)
+  input_ids = torch.full((len(rows), width), pad_id, dtype=torch.long, device=model.device)
+  attention_mask = torch.zeros((len(rows), width), dtype=torch.long, device=model.device)
+  for i, row in enumerate(rows):
+    input_ids[i, :shared] = row[:shared]
+    attention_mask[i, :shared] = 1
+    input_ids[i, width - row.shape[0] + shared:] = row[shared:]
+    attention_mask[i, width - row.shape[0] + shared:] = 1
+  enc = {"input_ids": input_ids, "attention_mask": attention_mask}
+  if past is not None:
+    enc["past_key_values"] = past
+
+  out = model.generate(
+      **enc,
+      **_cache_kwargs(enc),
+      max_new_tokens=MAX_NEW_TOKENS,
+      stopping_criteria=StoppingCriteriaList(
+          [JSONBalancedStop(tok, start_len=enc["input_ids"].shape[1])]
+      ),
+      logits_processor=_logits_processor(),
+      do_sample=False,
+      pad_token_id=pad_id,
+  )
+
+  texts = tok.batch_decode(out[:, enc["input_ids"].shape[1]:], skip_special_tokens=True)
+  results: List[Any] = []
+  for text in texts:
+    try:
+      results.append(extract_json(text))
+    except ValueError as e:
+      results.append(e)
+
+  return results
+
+
+def can_retry() -> bool:
+  """
+  A re-prompt only helps unconstrained generation; with the JSON logits
+  processor or llama.cpp grammar active a parse failure means the token
+  budget ran out, and a second attempt would fail the same way.
+  """
+  return (
+      MODEL_CACHE.get("json_processor") is None
+      and MODEL_CACHE.get("llama_grammar") is None
+  )
+
+
+def retry_prompt(prompt: str) -> str:
+  return prompt + RETRY_INSTRUCTIONS
+
+
+@torch.inference_mode()
+def retry_generate(prompt: str, error: Exception) -> Dict[str, Any]:
+  """
+  Second attempt after a parse failure. When the failed generation left its
+  KV cache behind, only RETRY_INSTRUCTIONS is appended and decoding resumes
+  from there; otherwise the whole prompt is re-run with the instructions.
+  """
+  past = getattr(error, "past_key_values", None)
+  if past is None or MODEL_CACHE.get("compiled"):
+    # A static cache is sized for the first call and cannot be extended.
+    return run_generate(retry_prompt(prompt))
+
+  tok, model = get_model()
+  suffix_ids = tok(
+      RETRY_INSTRUCTIONS,
+      return_tensors="pt",
+      add_special_tokens=False,
+  ).input_ids.to(model.device)
+  input_ids = torch.cat([error.sequences, suffix_ids], dim=1)
+  return _generate({
+      "input_ids": input_ids,
+      "attention_mask": torch.ones_like(input_ids),
+      "past_key_values": past,
+  })
+
+
+def warmup():
+  """Load (and optionally compile) the model and prefill the prompt prefix."""
+  if gguf_path():
+    # One token is enough to leave the prefix in llama.cpp's KV state.
+    get_llama()(_CONFIG["prompt_prefix"] or " ", max_tokens=1)
+    return
+
+  get_model()
+  if use_prefix_cache():
+    prefix_cache()
@@ -0,0 +1,31 @@
+"""
+Environment-driven settings shared by the GLB LLM scripts. Kept free of
+heavy imports so callers can read them without loading torch/transformers.
+"""
+
+import os
+
+# Upper bound on how many prompts share one model.generate call.
+MAX_BATCH = int(os.getenv("GLB_LLM_MAX_BATCH", "8"))
+
+# A schema-shaped answer (type, module key, short params; the section HTML is
+# never echoed back) is normally well under 200 tokens; generation also stops
+# early once a parseable object has been emitted (see JSONBalancedStop).
+MAX_NEW_TOKENS = int(os.getenv("GLB_LLM_MAX_NEW_TOKENS", "256"))
+
+# Separate budget for rewriting JSX/template markup as static HTML, which is
+# roughly as long as the section itself.
+NORMALIZE_MAX_NEW_TOKENS = int(os.getenv("GLB_LLM_NORMALIZE_MAX_NEW_TOKENS", "1536"))
+
+
+def cache_dir() -> str:
+  return os.getenv("GLB_LLM_CACHE_DIR", os.path.expanduser("~/.cache/glb_llm"))
+
+
+def gguf_path() -> str:
+  """Path of a GGUF model for the llama.cpp backend, or "" for transformers."""
+  return os.getenv("GLB_LLM_GGUF", "")
+
+
+def model_name() -> str:
+  return gguf_path() or os.getenv("GLB_LLM_MODEL", "microsoft/Phi-3-mini-4k-instruct")
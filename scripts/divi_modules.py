@@ -0,0 +1,43 @@
+"""
+Section types and Divi modules the layout generator understands. Single
+source of truth for the classifier prompt, its response schema and the
+numeric module keys the model answers with.
+"""
+
+from typing import Dict, Tuple
+
+# Closed vocabularies for the answer. generate-layout.js only knows how to
+# lay out these, and constrained decoding uses them as enums so the model
+# cannot drift into near-miss spellings.
+SECTION_CATALOG: Tuple[Tuple[str, str], ...] = (
+    ("hero", "big intro, main heading"),
+    ("feature_grid", "benefits, features, how-it-works steps, icons"),
+    ("pricing", "plans, prices, lifetime, $ amounts"),
+    ("testimonials", ""),
+    ("contact", "only when there is a real contact form or very clear contact markup"),
+    ("footer", ""),
+    ("generic", "fallback"),
+)
+
+DIVI_MODULES: Tuple[Tuple[str, str], ...] = (
+    ("text", "generic text / headings"),
+    ("blurb", "icon + title + text"),
+    ("blurb_grid", "multiple blurbs / features"),
+    ("slider", "generic slider"),
+    ("testimonials_slider", ""),
+    ("pricing_table", ""),
+    ("contact_form", ""),
+    ("button", ""),
+    ("feature_grid", "custom logical grouping of blurbs/features"),
+    ("hero", "hero layout: headline, subheadline, buttons"),
+    ("footer", ""),
+    ("code", "raw HTML/JS"),
+)
+
+SECTION_TYPES = tuple(name for name, _ in SECTION_CATALOG)
+MODULE_TYPES = tuple(name for name, _ in DIVI_MODULES)
+
+# The model answers module_type with a small integer key instead of the
+# module name: the legend is shorter than quoted names, and so is every
+# answer.
+MODULE_KEYS: Dict[str, int] = {name: key for key, name in enumerate(MODULE_TYPES)}
@@ -2,7 +2,8 @@
 
 const fs = require("fs");
 const path = require("path");
-const { spawnSync } = require("child_process");
+const { spawn } = require("child_process");
+const readline = require("readline");
 const https = require("https");
 const http = require("http");
 const url = require("url");
@@ -172,59 +173,113 @@ function analyzeApp(appDir) {
 }
 
 /**
- * Call the Python classifier for a single section HTML snippet.
- * We send a JSON payload on stdin to avoid escaping issues.
+ * Persistent Python classifier worker.
+ * The model is loaded once in `--serve` mode; each request is one JSON
+ * line on stdin and each answer is one JSON line on stdout, in order.
  */
-function classifySection(sectionHtml, appInfo, idx, pageTitle) {
-  const payload = {
-    html: sectionHtml,
-    context: {
-      framework: appInfo.framework,
-      pageTitle: pageTitle || "",
-      sectionIndex: idx,
-      framework_source: appInfo.framework_source || "",
-    },
-  };
+class ClassifierWorker {
+  constructor() {
+    const env = { ...process.env };
+    // Default model is now set inside the Python script,
+    // but we keep a sane fallback here if needed.
+    if (!env.GLB_LLM_MODEL) {
+      env.GLB_LLM_MODEL = "microsoft/Phi-3-mini-4k-instruct";
+    }
+
+    this.pending = [];
+    this.closed = false;
+    this.child = spawn("python", ["scripts/llm_classifier.py", "--serve"], {
+      env,
+      stdio: ["pipe", "pipe", "inherit"],
+    });
+
+    this.child.on("error", (err) => {
+      console.error("[LLM] classifier error:", err);
+      this.fail();
+    });
+    this.child.on("exit", (code) => {
+      if (code) console.error("[LLM] classifier non-zero exit:", code);
+      this.fail();
+    });
 
-  const env = { ...process.env };
-  // Default model is now set inside the Python script,
-  // but we keep a sane fallback here if needed.
-  if (!env.GLB_LLM_MODEL) {
-    env.GLB_LLM_MODEL = "microsoft/Phi-3-mini-4k-instruct";
+    readline
+      .createInterface({ input: this.child.stdout })
+      .on("line", (line) => this.onLine(line));
   }
 
-  const res = spawnSync("python", ["scripts/llm_classifier.py"], {
-    input: JSON.stringify(payload),
-    encoding: "utf8",
-    env,
-  });
+  onLine(line) {
+    const resolve = this.pending.shift();
+    if (!resolve) return;
 
-  if (res.error) {
-    console.error("[LLM] classifier error:", res.error);
-    return null;
+    const stdout = line.trim();
+    if (!stdout) {
+      console.error("[LLM] classifier returned empty output");
+      resolve(null);
+      return;
+    }
+
+    try {
+      const obj = JSON.parse(stdout);
+      if (obj && obj.error) {
+        console.error("[LLM] classifier failed:", obj.error);
+        resolve(null);
+        return;
+      }
+      resolve(obj);
+    } catch (e) {
+      console.error("[LLM] JSON parse error, stdout was:", stdout);
+      resolve(null);
+    }
   }
 
-  if (res.status !== 0) {
-    console.error("[LLM] classifier non-zero exit:", res.status);
-    console.error(res.stderr || res.stdout);
-    return null;
+  fail() {
+    this.closed = true;
+    while (this.pending.length) this.pending.shift()(null);
   }
 
-  const stdout = (res.stdout || "").trim();
-  if (!stdout) {
-    console.error("[LLM] classifier returned empty output");
-    return null;
+  request(payload) {
+    if (this.closed) return Promise.resolve(null);
+    return new Promise((resolve) => {
+      this.pending.push(resolve);
+      this.child.stdin.write(JSON.stringify(payload) + "\n");
+    });
   }
 
-  try {
-    const obj = JSON.parse(stdout);
-    return obj;
-  } catch (e) {
-    console.error("[LLM] JSON parse error, stdout was:", stdout);
-    return null;
+  close() {
+    if (!this.closed) this.child.stdin.end();
   }
 }
 
+/**
+ * Call the Python classifier for all section HTML snippets at once.
+ * The worker batches them into shared model.generate calls; the result
+ * array lines up with `sections`, with null for any section that failed.
+ */
+async function classifySections(worker, sections, appInfo, pageTitle) {
+  const items = sections.map((sectionHtml, idx) => ({
+    html: sectionHtml,
+    context: {
+      framework: appInfo.framework,
+      pageTitle: pageTitle || "",
+      sectionIndex: idx,
+      framework_source: appInfo.framework_source || "",
+    },
+  }));
+
+  const res = await worker.request({ items });
+  const results = (res && Array.isArray(res.results) && res.results) || [];
+
+  return sections.map((_, idx) => {
+    const obj = results[idx];
+    if (!obj) return null;
+    if (obj.error) {
+      console.error(`[LLM] classifier failed for section ${idx + 1}:`, obj.error);
+      return null;
+    }
+    return obj;
+  });
+}
+
 /**
  * Simple heuristics to veto obviously-wrong module picks.
  * e.g. don't create a contact form when there's no form / contact cues.
@@ -398,11 +453,20 @@ async function main() {
         builder: {},
       });
     } else {
+      const worker = new ClassifierWorker();
+      const classifications = await classifySections(
+        worker,
+        appInfo.sections,
+        appInfo,
+        pageTitle
+      );
+      worker.close();
+
       appInfo.sections.forEach((rawHtml, idx) => {
         const sectionId = `section-${idx + 1}`;
         const cls = `glb-section glb-section-${sectionId} glb-type-generic`;
 
-        const classification = classifySection(rawHtml, appInfo, idx, pageTitle);
+        const classification = classifications[idx];
         let type = "generic";
         let builderMap = {};
 
@@ -1,84 +1,105 @@
 #!/usr/bin/env python
 
+import copy
+import hashlib
 import json
 import os
+import queue
+import re
+import sqlite3
 import sys
-from typing import Any, Dict
-
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
-
-MODEL_CACHE: Dict[str, Any] = {}
-
-
-def load_model():
-  """Load (or reuse) the HF model + tokenizer."""
-  global MODEL_CACHE
-  if MODEL_CACHE:
-    return MODEL_CACHE["tok"], MODEL_CACHE["model"]
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from _llm_settings import MAX_BATCH, NORMALIZE_MAX_NEW_TOKENS, cache_dir, model_name
+from divi_modules import DIVI_MODULES, MODULE_KEYS, MODULE_TYPES, SECTION_CATALOG, SECTION_TYPES
+
+try:
+  from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+  try:  # selectolax < 0.3.13 only ships the Modest backend
+    from selectolax.parser import HTMLParser
+  except ImportError:  # optional: distill_html falls back to regexes
+    HTMLParser = None
+
+# Classifications of previously seen section HTML. Pages repeat the same
+# footer/CTA blocks, and across runs the same site is often re-processed, so
+# the in-memory LRU is backed by an SQLite file next to the model snapshot.
+RESULT_CACHE_SIZE = 512
+RESULT_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_RESULT_STORE: Any = None
+
+def _render_catalog(entries: Tuple[Tuple[str, str], ...]) -> str:
+  return "\n".join(
+      f'  - "{name}"' + (f" ({hint})" if hint else "")
+      for name, hint in entries
+  )
 
-  model_name = os.getenv("GLB_LLM_MODEL", "microsoft/Phi-3-mini-4k-instruct")
-  print(f'[llm_classifier] Using model: {model_name}', file=sys.stderr)
 
-  tok = AutoTokenizer.from_pretrained(model_name)
-  model = AutoModelForCausalLM.from_pretrained(
-      model_name,
-      torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-      device_map="auto"
+def _render_module_keys(entries: Tuple[Tuple[str, str], ...]) -> str:
+  return "\n".join(
+      f"  {MODULE_KEYS[name]}={name}" + (f" ({hint})" if hint else "")
+      for name, hint in entries
   )
 
-  MODEL_CACHE["tok"] = tok
-  MODEL_CACHE["model"] = model
-  return tok, model
 
-
-def build_prompt(html: str, context: Dict[str, Any]) -> str:
-  """
-  Build a strict prompt so the model:
-    - Chooses a semantic type (hero, feature_grid, pricing, testimonials, contact, footer, generic)
-    - Picks an appropriate Divi module
-    - Optionally returns normalized_html (static HTML, no JSX / loops)
-  """
-  framework = context.get("framework", "")
-  page_title = context.get("pageTitle", "")
-  section_index = context.get("sectionIndex", -1)
-
-  # IMPORTANT: no instructions to invent forms unless there clearly is one.
-  system_instructions = f"""
+# Rendered once at import into SYSTEM_PROMPT.
+_TYPES_BLOCK = _render_catalog(SECTION_CATALOG)
+_MODULES_BLOCK = _render_module_keys(DIVI_MODULES)
+
+# Shape every answer must have; used to constrain decoding when outlines is
+# installed so the first generation always parses.
+RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "type": {"type": "string", "enum": list(SECTION_TYPES)},
+        "builder": {
+            "type": "object",
+            "properties": {
+                "divi": {
+                    "type": "object",
+                    "properties": {
+                        "module_type": {"type": "integer", "enum": list(MODULE_KEYS.values())},
+                        "params": {"type": "object"},
+                    },
+                    "required": ["module_type", "params"],
+                    "additionalProperties": False,
+                },
+            },
+            "required": ["divi"],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["type", "builder"],
+    # No room for extra keys: in particular no echo of the section HTML,
+    # which would not fit the MAX_NEW_TOKENS budget (JSX/template sections
+    # get their static HTML from a separate call, see static_html).
+    "additionalProperties": False,
+}
+
+# Shared instructions for every section. Keeping this text static means the
+# tokenized prefix (and its KV cache) can be computed once per process.
+# IMPORTANT: no instructions to invent forms unless there clearly is one.
+SYSTEM_PROMPT = f"""
 You are a layout classifier that maps HTML/TSX sections into Divi Builder modules.
 
 You MUST respond with **only** a single JSON object, no markdown, no prose.
 
 Valid "type" values include:
-  - "hero" (big intro, main heading)
-  - "feature_grid" (benefits, features, how-it-works steps, icons)
-  - "pricing" (plans, prices, lifetime, $ amounts)
-  - "testimonials"
-  - "contact" (only when there is a real contact form or very clear contact markup)
-  - "footer"
-  - "generic" (fallback)
-
-You know these Divi modules (examples, not exhaustive):
-  - "text"              (generic text / headings)
-  - "blurb"             (icon + title + text)
-  - "blurb_grid"        (multiple blurbs / features)
-  - "slider"            (generic slider)
-  - "testimonials_slider"
-  - "pricing_table"
-  - "contact_form"
-  - "button"
-  - "feature_grid"      (custom logical grouping of blurbs/features)
-  - "hero"              (hero layout: headline, subheadline, buttons)
-  - "footer"
-  - "code"              (raw HTML/JS)
+{_TYPES_BLOCK}
+
+Divi modules; answer "module_type" with the module's key number:
+{_MODULES_BLOCK}
 
 RULES:
 
-1. Do NOT choose "contact" or "contact_form" unless the snippet clearly contains a real form:
+1. Do NOT choose "contact" or module {MODULE_KEYS["contact_form"]} (contact_form) unless the snippet clearly contains a real form:
    - <form>, <input>, <textarea>, <select>, or obvious contact text like "Contact Us", "Send Message", "Email".
    If those are missing, treat it as a feature or generic section instead.
 
-2. For pricing sections (type "pricing", module_type "pricing_table"):
+2. For pricing sections (type "pricing", module_type {MODULE_KEYS["pricing_table"]}):
    - There should be words like "Pricing", "Plan", "$39", "Lifetime", "Buy now", etc.
 
 3. For hero sections:
@@ -86,11 +107,8 @@ RULES:
 
 4. Fill "builder.divi.params" with **useful content** extracted from the HTML,
    such as headings, subheadings, bullet labels, CTA labels, etc.
-   This should be simple strings/arrays, not nested HTML.
-
-5. Include an optional "normalized_html" string:
-   - Best-effort STATIC HTML representing the content (no JSX/React, no {{ }}, no .map loops).
-   - If you cannot improve on the original, you may repeat the input HTML.
+   This should be simple strings/arrays, not nested HTML. Keep it short:
+   do NOT copy the section's HTML into the answer.
 
 Return JSON with this shape:
 
@@ -98,19 +116,120 @@ Return JSON with this shape:
   "type": "<one_of_the_types_above>",
   "builder": {{
     "divi": {{
-      "module_type": "<one_of_the_modules_above_or_reasonable_guess>",
+      "module_type": <module_key_number>,
       "params": {{
         "...": "..."
       }}
     }}
-  }},
-  "normalized_html": "<static HTML representation of the section>"
+  }}
 }}
 
-If you are unsure, choose "generic" and "code" but still try to provide normalized_html.
+If you are unsure, choose "generic" and module {MODULE_KEYS["code"]} (code).
 """
 
-  user_content = f"""
+PROMPT_PREFIX = SYSTEM_PROMPT.strip() + "\n\nUser:\n"
+
+# Set by --mode heuristic: settle every section from heuristics and the
+# result cache, never loading the model.
+HEURISTIC_ONLY = False
+
+_CORE: Any = None
+
+
+def _core():
+  """
+  The model code, imported on first use. Importing torch/transformers alone
+  takes seconds, which pages settled by heuristics or the cache never need.
+  """
+  global _CORE
+  if _CORE is None:
+    import _llm_core
+    _llm_core.configure(prompt_prefix=PROMPT_PREFIX, response_schema=RESPONSE_SCHEMA)
+    _CORE = _llm_core
+  return _CORE
+
+# Budget for the distilled section HTML (roughly 4 characters per token).
+# The opening markup decides the classification; long sections mostly
+# repeat the same card or list item, so prefilling the rest is wasted.
+MAX_HTML_CHARS = int(os.getenv("GLB_LLM_MAX_HTML_CHARS", "6000"))
+
+
+# Markup that carries no classification signal but dominates token counts.
+_DROP_TAGS = ("script", "style", "svg", "noscript", "template")
+_KEEP_ATTRS = ("id", "role", "aria-label", "href")
+
+_DROP_TAGS_RE = re.compile(r"<(%s)\b[^>]*>[\s\S]*?</\1\s*>" % "|".join(_DROP_TAGS), re.I)
+_COMMENT_RE = re.compile(r"<!--[\s\S]*?-->")
+_TAG_RE = re.compile(r"<([a-zA-Z][\w-]*)(\s[^>]*?)?(/?)>")
+_KEEP_ATTR_RE = re.compile(
+    r"""\s(%s)\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""" % "|".join(_KEEP_ATTRS), re.I
+)
+_ANY_TAG_RE = re.compile(r"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+
+
+def _distill_html_regex(html: str) -> str:
+  html = _DROP_TAGS_RE.sub("", html)
+  html = _COMMENT_RE.sub("", html)
+
+  def _tag(m: "re.Match") -> str:
+    kept = "".join(f" {a.group(1)}={a.group(2)}" for a in _KEEP_ATTR_RE.finditer(m.group(2) or ""))
+    return f"<{m.group(1)}{kept}{m.group(3)}>"
+
+  return " ".join(_TAG_RE.sub(_tag, html).split())
+
+
+def distill_html(html: str) -> str:
+  """
+  Reduce section HTML to tag names, text and the few attributes that say
+  what an element is for (id/role/aria-label/href). Classes, inline styles,
+  data-* attributes and SVG paths are usually most of the bytes and none of
+  the signal, so this typically shrinks the prompt several times over.
+  """
+  if HTMLParser is None:
+    return _distill_html_regex(html)
+
+  tree = HTMLParser(html)
+  tree.strip_tags(list(_DROP_TAGS))
+  root = tree.body or tree.root
+  if root is None:
+    return ""
+
+  for node in list(root.traverse(include_text=False)):
+    if node.tag in ("-comment", "_comment"):  # lexbor / Modest naming
+      node.decompose()
+      continue
+    for name in list(node.attributes):
+      if name not in _KEEP_ATTRS:
+        del node.attrs[name]
+
+  inner = "".join(child.html or "" for child in root.iter(include_text=True))
+  return " ".join(inner.split())
+
+
+def html_to_text(html: str) -> str:
+  """Visible text of a section, without script/style bodies or markup."""
+  if HTMLParser is None:
+    html = _COMMENT_RE.sub("", _DROP_TAGS_RE.sub("", html))
+    return " ".join(_ANY_TAG_RE.sub(" ", html).split())
+
+  tree = HTMLParser(html)
+  tree.strip_tags(list(_DROP_TAGS))
+  root = tree.body or tree.root
+  if root is None:
+    return ""
+  return " ".join(root.text(separator=" ").split())
+
+
+def _truncate_html(html: str) -> str:
+  """Cut html to MAX_HTML_CHARS, at the end of a tag where possible."""
+  if len(html) <= MAX_HTML_CHARS:
+    return html
+  cut = html.rfind(">", 0, MAX_HTML_CHARS) + 1
+  return html[:cut or MAX_HTML_CHARS]
+
+
+# Per-section part of the prompt; only these fields change between calls.
+_USER_TEMPLATE = """
 Framework: {framework}
 Page Title: {page_title}
 Section Index: {section_index}
@@ -120,89 +239,668 @@ Section Index: {section_index}
 --- SECTION SNIPPET END ---
 """
 
+
+def build_prompt(html: str, context: Dict[str, Any]) -> str:
+  """
+  Build a strict prompt so the model:
+    - Chooses a semantic type (hero, feature_grid, pricing, testimonials, contact, footer, generic)
+    - Picks an appropriate Divi module
+  """
+  framework = context.get("framework", "")
+  page_title = context.get("pageTitle", "")
+  section_index = context.get("sectionIndex", -1)
+  html = _truncate_html(distill_html(html))
+
+  user_content = _USER_TEMPLATE.format(
+      framework=framework,
+      page_title=page_title,
+      section_index=section_index,
+      html=html,
+  )
+
   # For Phi-3 instruct we can just concatenate; HF will apply a default chat template.
-  prompt = system_instructions.strip() + "\n\nUser:\n" + user_content.strip()
+  prompt = PROMPT_PREFIX + user_content.strip()
   return prompt
 
 
-def generate_json(prompt: str) -> Dict[str, Any]:
-  tok, model = load_model()
+# Confidence at which a heuristic guess is trusted without asking the model.
+HEURISTIC_MIN_CONFIDENCE = 0.85
+
+# Markup cues, combined into one alternation so a section is scanned once
+# instead of once per cue. Order matters only where two cues could match at
+# the same offset; "footer" is anchored to the start of the snippet.
+_MARKUP_CUES = (
+    ("footer", r"\A\s*<footer[\s>]"),
+    ("form", r"<form[\s>]"),
+    ("textarea", r"<textarea[\s>]"),
+    ("input", r"<(?:input|select)[\s>]"),
+    ("h1", r"<h1[\s>]"),
+    ("h3", r"<h3[\s>]"),
+    ("cta", r"<(?:button|a)[\s>]"),
+    ("blockquote", r"<blockquote[\s>]"),
+    # Class names/ids are a strong testimonial signal even without the word
+    # in the visible text.
+    ("testimonial_markup", r"""\b(?:class|id)\s*=\s*["'][^"']*testimonial"""),
+)
+
+# Keyword cues are matched against the visible text only, so URLs, inline
+# scripts and styles (e.g. "/plans" or "$1" in JS) cannot trigger them.
+# Navigation and link labels are left out too: every page header links to
+# "Pricing" and "Testimonials" (see _cue_text).
+_TEXT_CUES = (
+    ("price", r"\$\s*\d"),
+    ("pricing_words", r"pricing|per month|/\s*mo\b|\bplans?\b|lifetime"),
+    ("testimonial", r"testimonial|what (?:our )?(?:customers|clients|users) say"),
+    ("contact_words", r"contact|get in touch|message us|send (?:us )?(?:a )?message"),
+)
+
+
+def _cue_re(cues: Tuple[Tuple[str, str], ...]) -> "re.Pattern":
+  return re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in cues), re.I)
+
+
+_MARKUP_CUE_RE = _cue_re(_MARKUP_CUES)
+_TEXT_CUE_RE = _cue_re(_TEXT_CUES)
+
+# A section that is itself a <footer> is a footer whatever it contains
+# (newsletter forms, "Contact" and "Testimonials" links, ...).
+_FOOTER_RULE = ("footer", "footer", 0.9)
+
+# (type, module_type, confidence, minimum count per cue). A keyword alone is
+# never enough for HEURISTIC_MIN_CONFIDENCE: confident rules also need a
+# structural cue, and must agree on one type; otherwise the first matching
+# rule is only a guess.
+_HEURISTIC_RULES: Tuple[Tuple[str, str, float, Dict[str, int]], ...] = (
+    # A newsletter signup is a form with an input too: contact needs a
+    # message box or contact wording.
+    ("contact", "contact_form", 0.95, {"form": 1, "textarea": 1}),
+    ("contact", "contact_form", 0.95, {"form": 1, "input": 1, "contact_words": 1}),
+    # Pricing tables compare plans; a single "$5 off" next to the word
+    # "pricing" is as likely a blog teaser or a promo banner.
+    ("pricing", "pricing_table", 0.9, {"price": 2, "pricing_words": 1}),
+    ("testimonials", "testimonials_slider", 0.85, {"testimonial_markup": 1}),
+    ("testimonials", "testimonials_slider", 0.85, {"testimonial": 1, "blockquote": 1}),
+    ("hero", "hero", 0.85, {"h1": 1, "cta": 1}),
+    ("pricing", "pricing_table", 0.6, {"price": 1, "pricing_words": 1}),
+    ("testimonials", "testimonials_slider", 0.6, {"testimonial": 1}),
+    # Three or more card headings is the usual features/how-it-works grid,
+    # but FAQs, team and blog listings look the same: only a guess.
+    ("feature_grid", "feature_grid", 0.6, {"h3": 3}),
+)
+
+
+# Sections with less visible text than this (dividers, spacers, icon-only or
+# placeholder containers) carry nothing for the model to classify.
+MIN_SECTION_TEXT_CHARS = 20
+
+
+_LINK_TEXT_RE = re.compile(r"<(nav|a)\b[^>]*>[\s\S]*?</\1\s*>", re.I)
+
+
+def _cue_text(html: str) -> str:
+  """Visible text for the keyword cues: without nav menus and link labels."""
+  return html_to_text(_LINK_TEXT_RE.sub(" ", html))
+
+
+def _cue_counts(html: str, text: str) -> Dict[str, int]:
+  counts: Dict[str, int] = {}
+  for pattern, subject in ((_MARKUP_CUE_RE, html), (_TEXT_CUE_RE, text)):
+    for m in pattern.finditer(subject):
+      counts[m.lastgroup] = counts.get(m.lastgroup, 0) + 1
+  return counts
+
+
+def heuristic_classify(html: str) -> Tuple[str, str, float]:
+  """
+  Cheap markup/keyword guess at (type, module_type, confidence). These are
+  the same cues generate-layout.js uses to veto bad picks, so a confident
+  match here is what the model would be allowed to answer anyway.
+  """
+  counts = _cue_counts(html, _cue_text(html))
+  if counts.get("footer"):
+    return _FOOTER_RULE
+  matches = [
+      rule[:3]
+      for rule in _HEURISTIC_RULES
+      if all(counts.get(cue, 0) >= n for cue, n in rule[3].items())
+  ]
+  confident = [m for m in matches if m[2] >= HEURISTIC_MIN_CONFIDENCE]
+  if len({m[0] for m in confident}) > 1:
+    # e.g. a hero with a quote block: leave it to the model.
+    return "generic", "code", 0.0
+  if matches:
+    return (confident or matches)[0]
+  if len(html_to_text(html)) < MIN_SECTION_TEXT_CHARS:
+    # Passed through as raw HTML, which is what the model would fall back
+    # to anyway.
+    return "generic", "code", 1.0
+  return "generic", "code", 0.0
+
+
+def heuristic_result(html: str) -> Optional[Dict[str, Any]]:
+  """A full classification from heuristics alone, or None if not confident."""
+  section_type, module_type, confidence = heuristic_classify(html)
+  if confidence < HEURISTIC_MIN_CONFIDENCE:
+    return None
+  return finalize_result(
+      {"type": section_type, "builder": {"divi": {"module_type": module_type}}},
+      html,
+  )
+
 
-  inputs = tok(
-      prompt,
-      return_tensors="pt",
-      truncation=True,
-      max_length=4096,
+def heuristic(html: str) -> Dict[str, Any]:
+  """The heuristic classification of a section, however unsure it is."""
+  section_type, module_type, _ = heuristic_classify(html)
+  return finalize_result(
+      {"type": section_type, "builder": {"divi": {"module_type": module_type}}},
+      html,
   )
-  inputs = {k: v.to(model.device) for k, v in inputs.items()}
 
-  with torch.no_grad():
-    out = model.generate(
-        **inputs,
-        max_new_tokens=512,
-        do_sample=True,
-        temperature=0.1,
-        top_p=0.9,
-    )
 
-  full_text = tok.decode(out[0], skip_special_tokens=True)
+def finalize_result(result: Any, html: str) -> Dict[str, Any]:
+  """Apply minimal sanity defaults to a parsed model response."""
+  if not isinstance(result, dict):
+    raise ValueError("Model did not return an object")
+
+  result.setdefault("type", "generic")
+  result.setdefault("builder", {})
+  result["builder"].setdefault("divi", {})
+  result["builder"]["divi"].setdefault("module_type", "code")
+
+  # Map the prompt's numeric module key back to the module name; names
+  # (from heuristics, or a model ignoring the legend) pass through.
+  module_type = result["builder"]["divi"]["module_type"]
+  if isinstance(module_type, str) and module_type.strip().isdigit():
+    module_type = int(module_type)
+  if isinstance(module_type, int) and not isinstance(module_type, bool):
+    if not 0 <= module_type < len(MODULE_TYPES):
+      raise ValueError(f"Unknown module key: {module_type}")
+    result["builder"]["divi"]["module_type"] = MODULE_TYPES[module_type]
+  result["builder"]["divi"].setdefault("params", {})
+
+  # The classifier only sees distilled markup (no classes, src or alt), so
+  # it never supplies this; JSX/template sections get a static rewrite from
+  # with_static_html() afterwards.
+  result["normalized_html"] = html
+
+  return result
+
+
+_ID_ATTR_RE = re.compile(r"""\s+id\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""", re.I)
+
+
+# Everything besides the section and the model that shapes an answer. Part
+# of every result key, so editing the prompt, schema or module catalog
+# retires the answers cached under the old ones instead of serving them on.
+_PROMPT_VERSION = hashlib.sha256(
+    "\0".join(
+        (PROMPT_PREFIX, _USER_TEMPLATE, str(MAX_HTML_CHARS), json.dumps(RESPONSE_SCHEMA, sort_keys=True))
+    ).encode("utf-8")
+).hexdigest()
+
+
+def _result_key(html: str) -> str:
+  """
+  Content address of a section: generated ids (React/Next useId and the
+  like) differ between otherwise identical blocks, so they are ignored
+  along with whitespace. Case is kept: it is visible in the rendered text.
+  """
+  normalized = " ".join(_ID_ATTR_RE.sub("", html).split())
+  key = f"{model_name()}\0{_PROMPT_VERSION}\0{normalized}"
+  return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _result_store():
+  """The on-disk result cache, opened on first use; None if unavailable."""
+  global _RESULT_STORE
+  if _RESULT_STORE is None:
+    try:
+      os.makedirs(cache_dir(), exist_ok=True)
+      # Autocommit; several workers may share the file, so wait on locks
+      # briefly instead of failing.
+      _RESULT_STORE = sqlite3.connect(
+          os.path.join(cache_dir(), "results.sqlite"),
+          timeout=5.0,
+          isolation_level=None,
+          check_same_thread=False,
+      )
+      _RESULT_STORE.execute("CREATE TABLE IF NOT EXISTS results (k TEXT PRIMARY KEY, v TEXT)")
+    except Exception as e:
+      print(f"[llm_classifier] Result cache disabled: {e}", file=sys.stderr)
+      _RESULT_STORE = False
+  return _RESULT_STORE or None
+
+
+def _cacheable(result: Dict[str, Any]) -> Dict[str, Any]:
+  """
+  The part of a classification that holds for every section sharing its key.
+  normalized_html is tied to the exact markup and is rebuilt on each use.
+  """
+  return {
+      "type": result.get("type", "generic"),
+      "builder": copy.deepcopy(result.get("builder", {})),
+  }
 
-  # Try to extract the first JSON object in the output.
-  first_brace = full_text.find("{")
-  last_brace = full_text.rfind("}")
-  if first_brace == -1 or last_brace == -1 or last_brace <= first_brace:
-    raise ValueError("No JSON braces in model output")
 
-  json_str = full_text[first_brace:last_brace + 1]
+def _lookup(key: str) -> Optional[Dict[str, Any]]:
+  """A copy of the cached value for key, from memory or disk."""
+  if key in RESULT_CACHE:
+    RESULT_CACHE.move_to_end(key)
+    return copy.deepcopy(RESULT_CACHE[key])
 
+  store = _result_store()
+  if store is None:
+    return None
   try:
-    data = json.loads(json_str)
-  except Exception as e:
-    raise ValueError(f"JSON parse failure: {e}")
+    row = store.execute("SELECT v FROM results WHERE k = ?", (key,)).fetchone()
+    value = json.loads(row[0]) if row else None
+  except Exception:
+    return None
+  if not isinstance(value, dict):
+    return None
+  _store(key, value, persist=False)
+  return copy.deepcopy(value)
 
-  return data
 
+def cached_result(key: str, html: str) -> Optional[Dict[str, Any]]:
+  """A previous classification for this key applied to html, if any."""
+  result = _lookup(key)
+  if result is None:
+    return None
+  return finalize_result(_cacheable(result), html)
 
-def main():
-  raw = sys.stdin.read()
+
+def _remember(key: str, result: Dict[str, Any], persist: bool = True):
+  _store(key, _cacheable(result), persist)
+
+
+def _store(key: str, value: Dict[str, Any], persist: bool = True):
+  RESULT_CACHE[key] = value
+  RESULT_CACHE.move_to_end(key)
+  while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+    RESULT_CACHE.popitem(last=False)
+
+  store = _result_store() if persist else None
+  if store is not None:
+    try:
+      store.execute(
+          "INSERT OR REPLACE INTO results (k, v) VALUES (?, ?)",
+          (key, json.dumps(value)),
+      )
+    except Exception as e:
+      print(f"[llm_classifier] Could not persist cached result: {e}", file=sys.stderr)
+
+
+# Frameworks whose section markup is a component template rather than HTML
+# the page builder can render as is.
+_TEMPLATE_FRAMEWORKS = ("react", "angular")
+# JSX attributes and expressions, Angular/Vue interpolation and the like.
+_TEMPLATE_SYNTAX_RE = re.compile(r"\bclassName\s*=|\{")
+
+_NORMALIZE_PROMPT = """
+You convert {framework} component markup into the static HTML it renders.
+
+Rules:
+- Output ONLY the HTML, no markdown fences, no explanation.
+- Replace className with class and drop event handlers, refs and keys.
+- Replace {{expressions}} with the text they clearly stand for; expand
+  .map()/*ngFor loops over literal data into one element per item, or keep a
+  single representative item when the data is not shown.
+- Keep every tag, class, src, alt and href otherwise unchanged.
+
+User:
+{html}
+
+Static HTML:
+"""
+
+_FENCE_RE = re.compile(r"^\s*```[\w-]*\s*|\s*```\s*$")
+
+
+def needs_static_html(html: str, context: Dict[str, Any]) -> bool:
+  """Whether a section is JSX/template markup rather than renderable HTML."""
+  if str(context.get("framework", "")).lower() in _TEMPLATE_FRAMEWORKS:
+    return True
+  # Braces in inline CSS/JS are not template syntax.
+  return bool(_TEMPLATE_SYNTAX_RE.search(_DROP_TAGS_RE.sub("", html)))
+
+
+def _static_html_key(html: str) -> str:
+  # The exact markup: unlike classifications, the rewrite repeats its ids.
+  key = f"{model_name()}\0{_NORMALIZE_PROMPT}\0{html}"
+  return "static:" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def static_html(html: str, context: Dict[str, Any]) -> str:
+  """
+  A static HTML rendering of JSX/template section markup, generated in its
+  own call with NORMALIZE_MAX_NEW_TOKENS (the classification answer's budget
+  has no room for it). Falls back to html when the rewrite is unavailable,
+  would not fit the budget, or comes back cut off.
+  """
+  key = _static_html_key(html)
+  cached = _lookup(key)
+  if cached is not None:
+    return cached["html"]
+  # About 4 characters per token: a section longer than the budget can
+  # never be rewritten in full.
+  if HEURISTIC_ONLY or len(html) > 4 * NORMALIZE_MAX_NEW_TOKENS:
+    return html
+
+  prompt = _NORMALIZE_PROMPT.strip().format(
+      framework=context.get("framework") or "JSX", html=html
+  ) + "\n"
   try:
-    payload = json.loads(raw)
+    text, finished = _core().run_generate_text(prompt, NORMALIZE_MAX_NEW_TOKENS)
   except Exception as e:
-    print(f"[llm_classifier] Failed to parse stdin JSON: {e}", file=sys.stderr)
-    sys.exit(1)
+    print(f"[llm_classifier] Static HTML rewrite failed: {e}", file=sys.stderr)
+    return html
+  text = _FENCE_RE.sub("", text).strip()
+  if not finished or not text.startswith("<"):
+    print("[llm_classifier] Static HTML rewrite unusable, keeping the original", file=sys.stderr)
+    return html
 
-  html = payload.get("html", "")
-  context = payload.get("context", {}) or {}
+  _store(key, {"html": text})
+  return text
+
+
+def with_static_html(result: Dict[str, Any], html: str, context: Dict[str, Any]) -> Dict[str, Any]:
+  """Set normalized_html to a static rewrite for JSX/template sections."""
+  if "error" not in result and needs_static_html(html, context):
+    result["normalized_html"] = static_html(html, context)
+  return result
+
+
+def _parse_payload(payload: Any) -> Tuple[str, Dict[str, Any]]:
+  """
+  The (html, context) of a request. A missing or null html is an empty
+  section; anything else that is not a string is rejected.
+  """
+  if not isinstance(payload, dict):
+    raise ValueError("Expected a JSON object")
+  html = payload.get("html")
+  if html is None:
+    html = ""
+  if not isinstance(html, str):
+    raise ValueError(f"Expected html to be a string, got {type(html).__name__}")
+  context = payload.get("context")
+  return html, context if isinstance(context, dict) else {}
+
+
+def classify(payload: Dict[str, Any]) -> Dict[str, Any]:
+  """Classify one {html, context} payload; raises ValueError on failure."""
+  html, context = _parse_payload(payload)
+  return with_static_html(_classify(html, context), html, context)
+
+
+def _classify(html: str, context: Dict[str, Any]) -> Dict[str, Any]:
+  guess = heuristic_result(html)
+  if guess is not None:
+    return guess
+
+  key = _result_key(html)
+  cached = cached_result(key, html)
+  if cached is not None:
+    return cached
+  if HEURISTIC_ONLY:
+    return heuristic(html)
 
   prompt = build_prompt(html, context)
 
   try:
-    result = generate_json(prompt)
+    result = _core().run_generate(prompt)
   except Exception as e:
+    if not _core().can_retry():
+      raise ValueError(f"Constrained generation failed: {e}")
     # One retry with a more explicit error message if first attempt failed
     print(f"[llm_classifier] First attempt failed: {e}", file=sys.stderr)
-    retry_prompt = prompt + "\n\nIMPORTANT: Your previous response could not be parsed as JSON. " \
-                             "Now respond with ONLY a single valid JSON object, no explanation."
     try:
-      result = generate_json(retry_prompt)
+      result = _core().retry_generate(prompt, e)
     except Exception as e2:
-      print(f"[llm_classifier] Second attempt failed: {e2}", file=sys.stderr)
-      sys.exit(1)
+      raise ValueError(f"Second attempt failed: {e2}")
 
-  # Minimal sanity defaults
-  if not isinstance(result, dict):
-    print("[llm_classifier] Model did not return an object", file=sys.stderr)
-    sys.exit(1)
+  result = finalize_result(result, html)
+  _remember(key, result)
+  return result
 
-  result.setdefault("type", "generic")
-  result.setdefault("builder", {})
-  result["builder"].setdefault("divi", {})
-  result["builder"]["divi"].setdefault("module_type", "code")
-  result["builder"]["divi"].setdefault("params", {})
 
-  # normalized_html is optional; if missing, we just won't use it.
-  if "normalized_html" not in result:
-    result["normalized_html"] = html
+def classify_batch(payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  """
+  Classify several {html, context} payloads with batched generation.
+  Items that fail are returned as {"error": "..."} instead of raising.
+  """
+  htmls: List[str] = []
+  contexts: List[Dict[str, Any]] = []
+  results: List[Optional[Dict[str, Any]]] = []
+  for payload in payloads:
+    try:
+      html, context = _parse_payload(payload)
+      results.append(heuristic_result(html))
+    except ValueError as e:
+      # Only this item fails; it is never looked up or generated.
+      html, context = "", {}
+      results.append({"error": str(e)})
+    htmls.append(html)
+    contexts.append(context)
+
+  # Only sections the heuristics or the result cache could not settle go to
+  # the model, and identical sections within the batch are generated once.
+  keys = [_result_key(h) for h in htmls]
+  pending: List[int] = []
+  first_with_key: Dict[str, int] = {}
+  for i, r in enumerate(results):
+    if r is not None:
+      continue
+    results[i] = cached_result(keys[i], htmls[i])
+    if results[i] is None and keys[i] not in first_with_key:
+      first_with_key[keys[i]] = i
+      pending.append(i)
+  if HEURISTIC_ONLY:
+    for i in pending:
+      results[i] = heuristic(htmls[i])
+    pending = []
+  prompts = [build_prompt(htmls[i], contexts[i]) for i in pending]
+
+  # A lone prompt needs no padding, and run_generate's failures carry their
+  # KV cache so the retry resumes decoding instead of prefilling again.
+  generated: List[Any] = []
+  if len(prompts) == 1:
+    try:
+      generated = [_core().run_generate(prompts[0])]
+    except Exception as e:
+      generated = [e]
+  elif prompts:
+    generated = _core().run_generate_batch(prompts)
+
+  for i, prompt, result in zip(pending, prompts, generated):
+    try:
+      if isinstance(result, Exception):
+        if not _core().can_retry():
+          raise ValueError(f"Constrained generation failed: {result}")
+        # Retries are rare, so they run one at a time.
+        print(f"[llm_classifier] First attempt failed: {result}", file=sys.stderr)
+        try:
+          result = _core().retry_generate(prompt, result)
+        except Exception as e2:
+          raise ValueError(f"Second attempt failed: {e2}")
+      results[i] = finalize_result(result, htmls[i])
+      _remember(keys[i], results[i])
+    except Exception as e:
+      print(f"[llm_classifier] {e}", file=sys.stderr)
+      results[i] = {"error": str(e)}
+
+  # Copies of a generated section share its classification but keep their
+  # own markup.
+  for i, r in enumerate(results):
+    if r is None:
+      first = results[first_with_key[keys[i]]]
+      if "error" in first:
+        results[i] = dict(first)
+      else:
+        results[i] = finalize_result(_cacheable(first), htmls[i])
+
+  # Rewrites run per section after all classifications are in; identical
+  # markup is only rewritten once thanks to the cache.
+  return [
+      with_static_html(r, htmls[i], contexts[i])
+      for i, r in enumerate(results)
+  ]
+
+
+def classify_one(html: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+  """classify() for callers that hold the section HTML and context separately."""
+  return classify({"html": html, "context": context or {}})
+
+
+def handle(payload: Dict[str, Any]) -> Dict[str, Any]:
+  """Dispatch a request: {"items": [...]} is batched, anything else is one section."""
+  if isinstance(payload, dict) and isinstance(payload.get("items"), list):
+    return {"results": classify_batch(payload["items"])}
+  return classify(payload)
+
+
+def _answer(payload: Dict[str, Any]) -> Dict[str, Any]:
+  """handle() for one request, with a failure reported as {"error": "..."}."""
+  try:
+    return handle(payload)
+  except Exception as e:
+    print(f"[llm_classifier] {e}", file=sys.stderr)
+    return {"error": str(e)}
+
+
+# How long the worker waits for further requests to share a batch with the
+# one it just received. Callers firing sections concurrently land in the same
+# window; a lone request only pays this delay once.
+BATCH_WINDOW_S = float(os.getenv("GLB_LLM_BATCH_WINDOW_MS", "20")) / 1000.0
+
+
+def _read_lines(lines: "queue.Queue[Optional[str]]"):
+  for line in sys.stdin:
+    line = line.strip()
+    if line:
+      lines.put(line)
+  lines.put(None)
+
+
+def _collect(lines: "queue.Queue[Optional[str]]") -> Tuple[List[str], bool]:
+  """Block for one request, then gather whatever else arrives within the window."""
+  first = lines.get()
+  if first is None:
+    return [], True
+  group = [first]
+  deadline = time.monotonic() + BATCH_WINDOW_S
+  while len(group) < MAX_BATCH:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      break
+    try:
+      line = lines.get(timeout=remaining)
+    except queue.Empty:
+      break
+    if line is None:
+      return group, True
+    group.append(line)
+  return group, False
+
+
+def handle_lines(group: List[str]) -> List[Dict[str, Any]]:
+  """
+  Answer a group of request lines in order. Single-section requests in the
+  group are classified together in one batch; {"items": [...]} requests are
+  already batched and run as they are.
+  """
+  responses: List[Optional[Dict[str, Any]]] = [None] * len(group)
+  singles: List[Tuple[int, Dict[str, Any]]] = []
+  for i, line in enumerate(group):
+    try:
+      payload = json.loads(line)
+      if isinstance(payload, dict) and isinstance(payload.get("items"), list):
+        responses[i] = handle(payload)
+      else:
+        singles.append((i, payload))
+    except Exception as e:
+      print(f"[llm_classifier] {e}", file=sys.stderr)
+      responses[i] = {"error": str(e)}
+
+  if singles:
+    try:
+      results = classify_batch([payload for _, payload in singles])
+    except Exception as e:
+      # The group comes from independent callers: retry one by one so an
+      # error is only reported to the request that caused it.
+      print(f"[llm_classifier] Batch failed, classifying one by one: {e}", file=sys.stderr)
+      results = [_answer(payload) for _, payload in singles]
+    for (i, _), result in zip(singles, results):
+      responses[i] = result
+
+  return responses
+
+
+def serve():
+  """
+  Long-lived mode: answer one JSON request per stdin line with one JSON
+  response per stdout line, in request order. A request is either a single
+  {html, context} payload or {"items": [...]} for a batch. Failures are
+  reported as {"error": "..."} so the caller can keep the worker alive.
+
+  Single-section requests that arrive within BATCH_WINDOW_S of each other
+  are classified as one batch.
+
+  The model is loaded on the first request that actually needs it, so a
+  page settled entirely by heuristics or the result cache never loads it.
+  """
+  print("[llm_classifier] Ready", file=sys.stderr)
+
+  lines: "queue.Queue[Optional[str]]" = queue.Queue()
+  threading.Thread(target=_read_lines, args=(lines,), daemon=True).start()
+
+  done = False
+  while not done:
+    group, done = _collect(lines)
+    sys.stdout.write("".join(json.dumps(result) + "\n" for result in handle_lines(group)))
+    sys.stdout.flush()
+
+
+def main():
+  global HEURISTIC_ONLY
+  args = sys.argv[1:]
+
+  # --mode heuristic: no model at all, e.g. for quick previews or hosts
+  # without torch. --mode llm (the default) uses the model when needed.
+  mode = "llm"
+  if "--mode" in args:
+    i = args.index("--mode") + 1
+    mode = args[i] if i < len(args) else ""
+  if mode not in ("llm", "heuristic"):
+    print(f"[llm_classifier] Unknown --mode {mode!r}", file=sys.stderr)
+    sys.exit(2)
+  HEURISTIC_ONLY = mode == "heuristic"
+
+  # --warmup loads everything up front: on its own it just fills the model
+  # snapshot cache (e.g. in CI) and exits, with --serve it front-loads the
+  # cost before the first request.
+  if "--warmup" in args:
+    if not HEURISTIC_ONLY:
+      _core().warmup()
+    if "--serve" not in args:
+      return
+
+  if "--serve" in args:
+    serve()
+    return
+
+  raw = sys.stdin.read()
+  try:
+    payload = json.loads(raw)
+  except Exception as e:
+    print(f"[llm_classifier] Failed to parse stdin JSON: {e}", file=sys.stderr)
+    sys.exit(1)
+
+  try:
+    result = handle(payload)
+  except Exception as e:
+    print(f"[llm_classifier] {e}", file=sys.stderr)
+    sys.exit(1)
 
   sys.stdout.write(json.dumps(result))
 
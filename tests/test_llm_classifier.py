@@ -0,0 +1,99 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from llm_classifier import HEURISTIC_MIN_CONFIDENCE, heuristic_classify, heuristic_result  # noqa: E402
+
+NAV_HEADER = (
+    '<header><nav><a href="#features">Features</a><a href="#pricing">Pricing</a>'
+    '<a href="#testimonials">Testimonials</a><a href="#contact">Contact</a></nav>'
+    "<button>Sign up</button></header>"
+)
+
+
+class HeuristicClassifyTest(unittest.TestCase):
+
+  def assertSettled(self, html, section_type, module_type):
+    found_type, found_module, confidence = heuristic_classify(html)
+    self.assertEqual((found_type, found_module), (section_type, module_type))
+    self.assertGreaterEqual(confidence, HEURISTIC_MIN_CONFIDENCE)
+
+  def assertUnsettled(self, html):
+    _, _, confidence = heuristic_classify(html)
+    self.assertLess(confidence, HEURISTIC_MIN_CONFIDENCE)
+    self.assertIsNone(heuristic_result(html))
+
+  def test_nav_header_goes_to_the_model(self):
+    self.assertUnsettled(NAV_HEADER)
+
+  def test_hero_with_nav_links(self):
+    html = (
+        '<section><nav><a href="#testimonials">Testimonials</a></nav>'
+        "<h1>Build faster sites</h1><a class=\"btn\" href=\"/start\">Start</a></section>"
+    )
+    self.assertSettled(html, "hero", "hero")
+
+  def test_hero_with_quote_block_is_ambiguous(self):
+    html = (
+        "<section><h1>Loved by teams</h1><a href=\"/start\">Start</a>"
+        "<blockquote>Best tool ever, say our testimonials</blockquote></section>"
+    )
+    self.assertEqual(heuristic_classify(html), ("generic", "code", 0.0))
+
+  def test_testimonials_need_structure(self):
+    self.assertUnsettled("<section><h2>Testimonials</h2><p>Coming soon to this page</p></section>")
+    self.assertSettled(
+        "<section><h2>What our customers say</h2><blockquote>Great product</blockquote></section>",
+        "testimonials",
+        "testimonials_slider",
+    )
+    self.assertSettled(
+        '<section class="testimonial-carousel"><p>"Great product," says Ann</p></section>',
+        "testimonials",
+        "testimonials_slider",
+    )
+
+  def test_pricing_needs_several_prices(self):
+    self.assertUnsettled("<section><h3>Why our pricing changed</h3><p>$5 off this week</p></section>")
+    self.assertSettled(
+        "<section><h2>Pricing</h2><div>Starter $9 per month</div><div>Pro $29 per month</div></section>",
+        "pricing",
+        "pricing_table",
+    )
+
+  def test_footer_wins_over_its_forms_and_links(self):
+    html = (
+        '<footer><form><input type="email"><button>Subscribe</button></form>'
+        '<a href="/contact">Contact</a><p>Copyright 2024 Example Inc.</p></footer>'
+    )
+    self.assertSettled(html, "footer", "footer")
+
+  def test_contact_needs_message_box_or_wording(self):
+    self.assertUnsettled(
+        '<section><p>Join our newsletter for weekly tips</p><form><input type="email">'
+        "<button>Subscribe</button></form></section>"
+    )
+    self.assertSettled(
+        "<section><h2>Write to us</h2><form><input name=\"name\"><textarea></textarea></form></section>",
+        "contact",
+        "contact_form",
+    )
+    self.assertSettled(
+        "<section><h2>Get in touch</h2><form><input name=\"email\"><button>Send</button></form></section>",
+        "contact",
+        "contact_form",
+    )
+
+  def test_three_headings_are_only_a_guess(self):
+    html = "<section><h3>Q1?</h3><p>A.</p><h3>Q2?</h3><p>B.</p><h3>Q3?</h3><p>C, at length.</p></section>"
+    self.assertEqual(heuristic_classify(html)[:2], ("feature_grid", "feature_grid"))
+    self.assertUnsettled(html)
+
+  def test_near_empty_section_is_raw_html(self):
+    self.assertEqual(heuristic_classify('<div class="spacer"><hr></div>'), ("generic", "code", 1.0))
+
+
+if __name__ == "__main__":
+  unittest.main()